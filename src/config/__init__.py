@@ -1,8 +1,16 @@
+import os
 from dataclasses import dataclass
+from functools import cached_property, lru_cache
 from typing import Any, Dict, List
 
 import yaml
 
+try:
+    # libyaml's C loader is much faster, but it is only available when PyYAML was built against libyaml
+    from yaml import CSafeLoader as _SafeLoader
+except ImportError:
+    from yaml import SafeLoader as _SafeLoader
+
 from src.config.base import BaseConfig as _BaseConfig
 from src.config.db import Database as _Database
 
@@ -10,11 +18,22 @@ from src.config.db import Database as _Database
 @dataclass
 class Config(_BaseConfig):
 
+    Database = _Database
+
     @dataclass
     class FileFormat(_BaseConfig):
+        _NO_EXPAND = frozenset({"datetime"})
+
         prefix: str
         datetime: str
 
+        @cached_property
+        def effective_prefix(self) -> str:
+            """
+            The prefix as it appears in backup filenames, i.e., followed by an underscore unless it's blank.
+            """
+            return "" if self.prefix.strip() == "" else f"{self.prefix}_"
+
     @dataclass
     class PruningStrategy(_BaseConfig):
         keep_daily: int
@@ -36,17 +55,58 @@ class Config(_BaseConfig):
         """
         try:
             with open(config_path, "r") as config_file:
-                return dict(yaml.safe_load(config_file))
+                data = yaml.load(config_file, Loader=_SafeLoader)
         except FileNotFoundError as e:
             raise cls.ConfigLoadError(f'Config file "{config_path}" could not be found.') from e
         except Exception as e:
             raise cls.ConfigLoadError(
                 "Something went wrong while loading the config into memory. This is probably a YAML parsing error."
             ) from e
+        if not isinstance(data, dict):
+            # the YAML parsed, but into a scalar or a list instead of a mapping of config sections
+            raise cls.ConfigLoadError(
+                f'Config file "{config_path}" must contain a mapping of config sections at the top level.'
+            )
+        return data
 
     @classmethod
     def build(cls, config_path="config.yaml") -> "Config":
+        """
+        Build the config from a file path. The built config is cached until the file is modified.
+        """
         try:
+            mtime_ns = os.stat(config_path).st_mtime_ns
+        except FileNotFoundError as e:
+            raise cls.ConfigLoadError(f'Config file "{config_path}" could not be found.') from e
+        return _build_cached(str(config_path), mtime_ns)
+
+    @classmethod
+    def _build(cls, config_path="config.yaml") -> "Config":
+        """
+        Load and build the config from a file path.
+        """
+        data = cls._load_data(config_path)
+        try:
+            databases_data = data["databases"]
+            databases: List[_Database] = []
+            postgres = Config.Database.Provider.POSTGRES
+            databases.extend(
+                Config.Database(
+                    provider=postgres,
+                    name=db["name"],
+                    host=db["host"],
+                    port=db["port"],
+                    username=db["username"],
+                    password=db["password"],
+                )
+                for db in (databases_data.get("postgres") or ())
+            )
+            sqlite = Config.Database.Provider.SQLITE
+            databases.extend(
+                # Database name is just the sqlite file path here, and everything else is left blank.
+                Config.Database(provider=sqlite, name=db["path"], host="", port="", username="", password="")
+                for db in (databases_data.get("sqlite") or ())
+            )
             return Config(
                 rclone_remote=data["rclone"]["remote"],
                 file_format=Config.FileFormat(
@@ -60,33 +120,17 @@ class Config(_BaseConfig):
                     keep_monthly=data["pruning"]["keep_monthly"],
                     keep_yearly=data["pruning"]["keep_yearly"],
                 ),
-                databases=[
-                    *[
-                        Config.Database(
-                            provider=Config.Database.Provider.POSTGRES,
-                            name=db["name"],
-                            host=db["host"],
-                            port=db["port"],
-                            username=db["username"],
-                            password=db["password"],
-                        )
-                        for db in (data["databases"]["postgres"] if data["databases"]["postgres"] else [])
-                    ],
-                    *[
-                        # Database name is just the sqlite file path here, and everything else is left blank.
-                        Config.Database(
-                            provider=Config.Database.Provider.SQLITE,
-                            name=db["path"],
-                            host="",
-                            port="",
-                            username="",
-                            password="",
-                        )
-                        for db in (data["databases"]["sqlite"] if data["databases"]["sqlite"] else [])
-                    ],
-                ],
+                databases=databases,
                 logdir=data["logs"]["dir"],
             )
 
         except (KeyError, ValueError) as e:
-            raise Config.InvalidConfig from e
+            raise cls.ConfigBuildError(f"The config file \"{config_path}\" is missing or has an invalid value.") from e
+
+
+@lru_cache(maxsize=4)
+def _build_cached(config_path: str, mtime_ns: int) -> Config:
+    """
+    Memoize built configs. The modification time is part of the key so an edited file is rebuilt.
+    """
+    return Config._build(config_path)
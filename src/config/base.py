@@ -1,11 +1,14 @@
 import os
 import re
-from typing import Any, List
+from dataclasses import fields
+
+_ENV_VAR_RE = re.compile(r"\$\{([^}]+)\}")
 
 
 class BaseConfig:
     """
-    Base config handles environment variable substution automatically for any string-typed attributes.
+    Base config for dataclasses that handles environment variable substution automatically for any
+    string-typed attributes when the config is initialized.
     """
 
     class ConfigError(Exception):
@@ -29,33 +32,40 @@ class BaseConfig:
 
         ...
 
+    # Attributes that never contain environment variables, e.g., format strings. Subclasses may override this.
+    _NO_EXPAND: frozenset = frozenset()
+
     def _expand_env_var(self, path: str) -> str:
         """
-        Expand environment variables in the path and raise `MissingEnvVar` if any
+        Expand environment variables in the path and raise `ConfigBuildError` if any
         variable is missing from the environment.
         """
-        if not bool(re.search(r"\$\{[^}]+\}", path)):
+        if "${" not in path:
             # no varnames are in the path
             return path
-        expanded = os.path.expandvars(path)
-        if expanded == path:
-            # expansion didn't happen but there is an env var pattern. This means the var is not set.
-            raise self.ConfigBuildError(
-                f"One or more variable(s) in the string '{path}' is missing from the environment but required in the config."
-            )
-        return expanded
-
-    def __setattr__(self, key: str, value: Any) -> None:
-        """
-        Attempt to inject environment variables defined by the syntax '${VAR_NAME}'
-        when string attributes are set.
-        """
-        if isinstance(value, str):
-            expanded = self._expand_env_var(value)
-            super().__setattr__(key, expanded)
-        elif isinstance(value, List):
-            expanded = [self._expand_env_var(x) if isinstance(x, str) else x for x in value]
-            super().__setattr__(key, expanded)
-        else:
-            # normal setattr for all other datatypes
-            super().__setattr__(key, value)
+
+        def _replace(match: re.Match) -> str:
+            try:
+                return os.environ[match.group(1)]
+            except KeyError:
+                raise self.ConfigBuildError(
+                    f"One or more variable(s) in the string '{path}' is missing from the environment but required in the config."
+                ) from None
+
+        return _ENV_VAR_RE.sub(_replace, path)
+
+    def __post_init__(self) -> None:
+        """
+        Inject environment variables defined by the syntax '${VAR_NAME}' into the string
+        attributes, and strings in list attributes, once the dataclass is initialized.
+        """
+        expand = self._expand_env_var
+        for field in fields(self):  # type: ignore
+            if field.name in self._NO_EXPAND:
+                continue
+            value = self.__dict__[field.name]
+            if type(value) is str:
+                if "${" in value:
+                    self.__dict__[field.name] = expand(value)
+            elif type(value) is list:
+                self.__dict__[field.name] = [expand(x) if type(x) is str and "${" in x else x for x in value]
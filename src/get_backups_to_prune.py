@@ -6,7 +6,7 @@ import sys
 from collections import namedtuple
 from datetime import datetime, timedelta
 from enum import Enum
-from typing import Any, List
+from typing import Any, List, Optional
 
 help = """
 This script finds which timestamped backup filenames should be pruned according to some number
@@ -108,6 +108,14 @@ class BucketFactory:
         ]
 
 
+def parse_timestamp(filename: str, file_format: str) -> Optional[datetime]:
+    """The timestamp of a backup filename, or None if the filename doesn't match the format."""
+    try:
+        return datetime.strptime(filename, file_format).astimezone()
+    except ValueError:
+        return None
+
+
 def should_prune(
     filenames,
     file_format,
@@ -121,8 +129,8 @@ def should_prune(
     Returns a list of filenames to prune.
     """
 
-    # Parse timestamps
-    files_with_ts = [(fn, datetime.strptime(fn, file_format).astimezone()) for fn in filenames]
+    # Parse timestamps, and leave alone any filenames that don't match the format
+    files_with_ts = [(fn, parse_timestamp(fn, file_format)) for fn in filenames]
     files_with_ts = [(fn, ts) for fn, ts in files_with_ts if ts]
 
     # Sort newest -> oldest
@@ -161,8 +169,9 @@ if __name__ == "__main__":
         print(f"Error: Couldn't find input file '{args.input_file}'.")
         sys.exit(1)
 
-    with open(args.input_file, "r") as f:
-        filenames = [line.strip() for line in f if line.strip()]
+    with open(args.input_file, "r", buffering=1 << 16) as f:
+        # isspace() skips blank lines without allocating a stripped copy of every line twice
+        filenames = [line.strip() for line in f if not line.isspace()]
 
     to_prune = should_prune(
         filenames=filenames,
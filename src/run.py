@@ -3,10 +3,12 @@
 from __future__ import annotations
 
 import argparse
+import contextlib
 import json
 import logging
 import os
 import re
+import shutil
 import subprocess
 import sys
 import time
@@ -15,18 +17,19 @@ from dataclasses import dataclass
 from datetime import datetime, timedelta
 from enum import Enum
 from functools import lru_cache
-from logging.handlers import TimedRotatingFileHandler
-from typing import Any, List
+from logging.handlers import MemoryHandler, TimedRotatingFileHandler
+from typing import Any, Iterator, List
 from uuid import uuid4
 
 from src.get_backups_to_prune import should_prune
 
 Arguments = namedtuple(
     "ArgNamespace",
-    ["live", "log_level", "disable_pruning", "ignore_missing_dirs"],
+    ["live", "log_level", "disable_pruning", "ignore_missing_dirs", "multi_file_upload", "compression_level"],
 )
 
 
+@lru_cache(maxsize=1)
 def get_arguments() -> Arguments:
     """Parse script arguments"""
     parser = argparse.ArgumentParser()
@@ -50,41 +53,61 @@ def get_arguments() -> Arguments:
     )
     parser.add_argument(
         "-i",
+        dest="ignore_missing_dirs",
         default=False,
         action="store_true",
         help="Ignore missing dirs and proceed with the backup without prompting. This flag is ignored when service mode is enabled.",
     )
+    parser.add_argument(
+        "--multi-file-upload",
+        default=False,
+        action="store_true",
+        help="Upload the backup files individually into a timestamped folder on the remote instead of as a single archive. Pruning only considers backups made in the current mode.",
+    )
+    parser.add_argument(
+        "--compression-level",
+        default=3,
+        type=int,
+        choices=range(1, 20),
+        metavar="[1-19]",
+        help="The zstd compression level for the backup archive. Use 1 when backing up mostly already-compressed files.",
+    )
     args = parser.parse_args()
-    setattr(args, "ignore_missing_dirs", args.i)
-    return args  # type: ignore
+    return Arguments(**vars(args))
+
+
+_SCRIPT_PATH = os.path.abspath(__file__)
+_PARENT_PATH = os.path.dirname(_SCRIPT_PATH)
+_PARENT_DIR = os.path.basename(_PARENT_PATH)
 
 
-@lru_cache(maxsize=1)
 def parent_path() -> str:
-    script_path = os.path.abspath(__file__)
-    return os.path.dirname(script_path)
+    return _PARENT_PATH
 
 
-@lru_cache(maxsize=1)
 def parent_dir() -> str:
-    script_path = os.path.abspath(__file__)
-    parent_path = os.path.dirname(script_path)
-    return os.path.basename(parent_path)
+    return _PARENT_DIR
 
 
 def config_path() -> str:
     return f"{parent_dir()}/config.yaml"
 
 
+# Replaces the characters that aren't safe in a dump filename
+_SANITIZE = str.maketrans({"/": "_", ".": "_"})
+
+_NOW_FMT = "%Y-%m-%d %I:%M:%S %p %Z%z"
+
+
 def now_str() -> str:
-    return datetime.now().astimezone().strftime("%Y-%m-%d %I:%M:%S %p %Z%z")
+    # The local timezone is looked up on every call on purpose, a cached offset would be wrong after a DST change.
+    return datetime.now().astimezone().strftime(_NOW_FMT)
 
 
 def format_seconds(seconds: int) -> str:
-    td = timedelta(seconds=seconds)
-    days = td.days
-    hours, remainder = divmod(td.seconds, 3600)
-    minutes, _ = divmod(remainder, 60)
+    days, remainder = divmod(int(seconds), 86400)
+    hours, remainder = divmod(remainder, 3600)
+    minutes = remainder // 60
     if days != 0:
         return f"{days}d {hours}h {minutes}m"
     if hours != 0:
@@ -108,9 +131,51 @@ def run(*args, check=True, capture_output=True, text=True, **kwargs) -> subproce
     return subprocess.run(args, text=text, check=check, capture_output=capture_output, **kwargs)
 
 
-def refresh_current_backups_from_rclone(config: Config):
+def _scantree(path: str) -> Iterator[os.DirEntry]:
+    """Recursively yield the entries under a directory without following symlinks."""
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                yield entry
+                if entry.is_dir(follow_symlinks=False):
+                    yield from _scantree(entry.path)
+    except OSError:
+        # unreadable directories are skipped, like `du` does
+        return
+
+
+def disk_usage(*paths: str) -> int:
+    """The total size in bytes of the given files and the regular files under the given directories, like `du -sbc`."""
+    total = 0
+    for path in paths:
+        if os.path.isfile(path):
+            total += os.stat(path).st_size
+        else:
+            total += sum(
+                entry.stat(follow_symlinks=False).st_size
+                for entry in _scantree(path)
+                if entry.is_file(follow_symlinks=False)
+            )
+    return total
+
+
+def remote_path(remote: str, path: str) -> str:
+    """
+    Join a path onto an rclone remote. A bare remote like "name:" must not get a "/", since
+    "name:/path" points at the root of the remote's filesystem rather than its default directory.
+    """
+    path = path.lstrip("/")
+    return f"{remote}{path}" if remote.endswith(":") else f"{remote.rstrip('/')}/{path}"
+
+
+def refresh_current_backups_from_rclone(config: Config) -> List[str]:
+    """
+    List the backups on the rclone remote, save the listing to `current_backups.txt`, and return the filenames.
+    """
+    listing = run("rclone", "lsf", config.rclone_remote).stdout
     with open(f"{parent_path()}/current_backups.txt", "w") as f:
-        subprocess.run(["rclone", "lsf", config.rclone_remote], stdout=f)
+        f.write(listing)
+    return [line for line in listing.splitlines() if line.strip()]
 
 
 class BackupRunner:
@@ -120,15 +185,9 @@ class BackupRunner:
         The backup directory was not found.
         """
 
-        def __init__(self, dirname: str):
+        def __init__(self, dirname: str, path: str):
             self.dirname = dirname
-            super().__init__(
-                "The directory '{}' was not found. Paths checked: [{}, {}]".format(
-                    dirname,
-                    dirname,
-                    f"{os.getcwd()}/{dirname}",
-                )
-            )
+            super().__init__(f"The directory '{dirname}' was not found. Path checked: {path}")
 
     class SkipDir(Exception):
         """
@@ -145,10 +204,13 @@ class BackupRunner:
 
     def _logger_from_config(self, config: Config) -> logging.Logger:
         logger = logging.getLogger(__name__)
+        if logger.handlers:
+            # the module-level logger is already set up, adding handlers again would duplicate every log line
+            return logger
         logger.setLevel(logging.DEBUG)
         console_handler = logging.StreamHandler(sys.stdout)
         console_handler.setLevel(get_arguments().log_level)
-        run("mkdir", "-p", f"{parent_dir()}/{config.logdir}")
+        os.makedirs(f"{parent_dir()}/{config.logdir}", exist_ok=True)
         file_handler = TimedRotatingFileHandler(
             f"{parent_dir()}/{config.logdir}/log.txt",
             when="midnight",  # rotate once per day at midnight
@@ -163,33 +225,142 @@ class BackupRunner:
         )
         console_handler.setFormatter(formatter)
         file_handler.setFormatter(formatter)
+        # Batch file writes, but write immediately when an error is logged. Logging flushes the buffer at exit.
+        buffered_file_handler = MemoryHandler(capacity=200, flushLevel=logging.ERROR, target=file_handler)
 
         # Add handlers
         logger.addHandler(console_handler)
-        logger.addHandler(file_handler)
+        logger.addHandler(buffered_file_handler)
         return logger
 
-    def _parse_dirname(self, dirname: str) -> str:
+    def _parse_dirname(self, dirname: str, cwd: str, ignore_missing: bool) -> str:
         """
-        Make sure the directory name exists on the machine. This method tries
-        the following in order: 1.) absolute path, and 2.) relative path from the
-        parent directory to where `run.py` is located, i.e., the current working
+        Make sure the directory name exists on the machine. Absolute paths are used
+        as-is, and relative paths are resolved from `cwd`, i.e., the current working
         directory when running the script. Will raise an exception if the directory
         doesn't exist and otherwise return the guaranteed path to the directory.
         """
-        if os.path.exists(dirname):
-            return dirname
-        elif os.path.exists(f"{os.getcwd()}/{dirname}"):
-            return f"{os.getcwd()}/{dirname}"
-        elif get_arguments().ignore_missing_dirs == True or self.config.service_mode.enabled == True:
+        path = dirname if os.path.isabs(dirname) else f"{cwd}/{dirname}"
+        if os.path.exists(path):
+            return path
+        elif ignore_missing == True or getattr(getattr(self.config, "service_mode", None), "enabled", False) == True:
             # Ignore missing directories if "-i" flag passed or we are running in service mode (since a daemon
             # shouldn't prompt the CLI for input to make a decision.)
             raise self.SkipDir(dirname)
-        raise self.DirNotFound(dirname)
+        raise self.DirNotFound(dirname, path)
+
+    def _compress(self, dir_paths: List[str], workspace: str, out_path: str, level: int) -> None:
+        """
+        Stream the backup directories and the workspace into a single zstd-compressed tar archive.
+        """
+        # tar -cf - -C / dirs... -C workspace . | pv -s $(du -sbc dirs... workspace) | zstd -T0 --long -<level> -
+        tar_proc = subprocess.Popen(
+            # "-" = write tar to stdout. Directories are stored relative to "/" and database dumps at the root.
+            ["tar", "-cf", "-", "-C", "/", *[path.lstrip("/") for path in dir_paths], "-C", workspace, "."],
+            stdout=subprocess.PIPE,
+        )
+        procs = [tar_proc]
+        # pv draws its progress bar on stderr, which nobody reads when it's redirected, e.g., under systemd
+        if sys.stderr.isatty():
+            num_bytes = disk_usage(*dir_paths, workspace)
+            # piped uncompressed output to progress viewer to see progress bar
+            procs.append(subprocess.Popen(["pv", "-s", str(num_bytes)], stdin=tar_proc.stdout, stdout=subprocess.PIPE))
+            if tar_proc.stdout:
+                # let tar_proc get SIGPIPE if pv exits
+                tar_proc.stdout.close()
+        with open(out_path, "wb") as out_file:
+            # "-T0" = use one compression thread per core, "--long" = match across a 128MB window
+            zstd_proc = subprocess.Popen(
+                ["zstd", "-T0", "--long", f"-{level}", "-"],
+                stdin=procs[-1].stdout,
+                stdout=out_file,
+            )
+            if procs[-1].stdout:
+                procs[-1].stdout.close()
+            zstd_proc.communicate()
+        for proc in [*procs, zstd_proc]:
+            proc.wait()
+            # tar exits with 1 when a file changed while it was being read, which is expected when backing up
+            # directories that are in use. The archive is still complete, so only tar's fatal errors (2) count.
+            allowed = (0, 1) if proc is tar_proc else (0,)
+            if proc.returncode not in allowed:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(out_path)
+                raise subprocess.CalledProcessError(proc.returncode, proc.args)
+
+    def _upload_files(self, dir_paths: List[str], workspace: str, destination: str) -> None:
+        """
+        Upload the backup directories and the workspace to the destination without archiving them, so
+        rclone can transfer many files in parallel. Uses the same layout as the archive.
+        """
+        manifest_path = f"{parent_path()}/upload_manifest.txt"
+        try:
+            with open(manifest_path, "w") as manifest:
+                for dir_path in dir_paths:
+                    if os.path.isfile(dir_path):
+                        # os.walk yields nothing for a file, but config entries may point at single files
+                        manifest.write(os.path.relpath(dir_path, "/") + "\n")
+                        continue
+                    for root, _, filenames in os.walk(dir_path):
+                        for filename in filenames:
+                            manifest.write(os.path.relpath(os.path.join(root, filename), "/") + "\n")
+            # "--no-traverse" skips listing the destination, which is always a brand new folder
+            rclone_args = ["--no-traverse", "--transfers", "16"]
+            run("rclone", "copy", "/", destination, "--files-from", manifest_path, *rclone_args, capture_output=False)
+            run("rclone", "copy", workspace, destination, *rclone_args, capture_output=False)
+        finally:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(manifest_path)
+
+    def _prune(self, backup_suffix: str, multi_file_upload: bool) -> None:
+        """
+        Delete the backups on the rclone remote that fall outside of the pruning strategy.
+        """
+        try:
+            filenames = refresh_current_backups_from_rclone(self.config)
+        except subprocess.CalledProcessError as e:
+            # the backup itself is already uploaded, so a failed listing shouldn't fail the run
+            self.logger.warning(f"Skipping pruning because the rclone remote could not be listed: {e.stderr}")
+            return
+
+        # Find backups to prune
+        file_format = self.config.file_format
+        to_prune = should_prune(
+            filenames=filenames,
+            file_format=f"{file_format.effective_prefix}{file_format.datetime}{backup_suffix}",
+            keep_daily=self.config.pruning.keep_daily,
+            keep_weekly=self.config.pruning.keep_weekly,
+            keep_monthly=self.config.pruning.keep_monthly,
+            keep_yearly=self.config.pruning.keep_yearly,
+        )
+        self.logger.debug(f"{len(to_prune)} files to prune: {to_prune}.")
+
+        # Prune backups with a single rclone call. "--no-traverse" skips listing the whole remote.
+        if to_prune and multi_file_upload:
+            self.logger.info(f"Pruning {to_prune}...")
+            # filter patterns are anchored at the remote root, so they use the same joining rules as paths
+            includes = [arg for name in to_prune for arg in ("--include", remote_path("/", f"{name}**"))]
+            run("rclone", "delete", self.config.rclone_remote, *includes, "--rmdirs", capture_output=False)
+        elif to_prune:
+            self.logger.info(f"Pruning {to_prune}...")
+            # "--files-from -" reads the prune list from stdin, so it never touches the disk
+            run(
+                "rclone",
+                "delete",
+                self.config.rclone_remote,
+                "--files-from",
+                "-",
+                "--no-traverse",
+                input="\n".join(to_prune) + "\n",
+                capture_output=False,
+            )
 
     def run(self) -> None:
-        LIVE = bool(get_arguments().live)
-        ZIP_DIR = f"{uuid4().hex}_tmp_backup_manager_workspace"
+        args = get_arguments()
+        LIVE = bool(args.live)
+        MULTI_FILE_UPLOAD = bool(args.multi_file_upload)
+        IGNORE_MISSING = bool(args.ignore_missing_dirs)
+        WORKSPACE_DIR = f"{uuid4().hex}_tmp_backup_manager_workspace"
 
         self.logger.info("Starting backup...")
 
@@ -207,10 +378,13 @@ class BackupRunner:
         }
         self.logger.debug(f"Loaded config: {json.dumps(data, indent=2)}")
 
-        # warn if directory to backup is missing
+        # Resolve the directories to backup once, and warn if any are missing. The resolved paths are
+        # streamed straight into tar later instead of being staged in the workspace.
+        dir_paths = []
+        cwd = os.getcwd()
         for dirname in self.config.dirs:
             try:
-                parsed_dirname = self._parse_dirname(dirname)
+                dir_paths.append(os.path.abspath(self._parse_dirname(dirname, cwd, IGNORE_MISSING)))
             except self.DirNotFound:
                 backup = wait_for_confirm(
                     f"[WARNING]: Could not find directory '{dirname}'. Do you wish to proceed"
@@ -218,8 +392,9 @@ class BackupRunner:
                 if backup == False:
                     self.logger.info("Backup cancelled.")
                     exit(0)
+                self.logger.warning(f"Skipping dir '{dirname}' because it was not found.")
             except self.SkipDir:
-                continue
+                self.logger.warning(f"Skipping dir '{dirname}' because it was not found.")
 
         # Check database connections exist
         for db in config.databases:
@@ -228,90 +403,64 @@ class BackupRunner:
                 exit(1)
 
         # Backup the databases
-        BACKUP_WORKSPACE = f"{parent_path()}/{ZIP_DIR}"
+        BACKUP_WORKSPACE = f"{parent_path()}/{WORKSPACE_DIR}"
         BACKUP_TIMESTAMP = datetime.now().astimezone().strftime(config.file_format.datetime)
-        run("mkdir", BACKUP_WORKSPACE)
+        # multi-file backups are folders on the remote, which rclone lists with a trailing "/"
+        BACKUP_SUFFIX = "/" if MULTI_FILE_UPLOAD else ".tar.zst"
+        BACKUP_NAME = f"{config.file_format.effective_prefix}{BACKUP_TIMESTAMP}{BACKUP_SUFFIX}"
+        COMPRESSED_BACKUP_PATH = f"{parent_dir()}/{BACKUP_NAME}"
+        os.mkdir(BACKUP_WORKSPACE)
         self.logger.info(f"Created temporary workspace: '{BACKUP_WORKSPACE}'.")
-        for i, db in enumerate(sorted(config.databases, key=lambda db: db.name)):
-            # use index to make sure names are unique and throw in db name for identification
-            self.logger.info(f"Dumping database {db}...")
-            dump_path = f"{BACKUP_WORKSPACE}/{BACKUP_TIMESTAMP}_{db.name.replace('/', '_').replace('.', '_')}_{i}"
-            db.dump(dump_path)
-
-        self.logger.info(f"Copying backup directories {config.dirs}...")
-        for dirname in config.dirs:
-            try:
-                parsed_dirname = self._parse_dirname(dirname)
-                self.logger.debug(f"Copying {dirname}...")
-                run("mkdir", "-p", f"{BACKUP_WORKSPACE}/{dirname}")
-                run("cp", "-r", parsed_dirname, f"{BACKUP_WORKSPACE}/{dirname}", capture_output=False)
-            except (self.SkipDir, self.DirNotFound):
-                self.logger.warning(f"Skipping dir '{dirname}' because it was not found.")
-
-        prefix = config.file_format.prefix
-        prefix = "" if prefix.strip() == "" else f"{prefix}_"
-        COMPRESSED_BACKUP_PATH = f"{parent_dir()}/{prefix}{BACKUP_TIMESTAMP}.zip"
-        self.logger.info(f"Compressing files to {COMPRESSED_BACKUP_PATH}...")
-        # zip -r - folder/ | pv -s $(du -sb folder/ | awk '{print $1}')
-        du_result = run("du", "-sb", f"{parent_dir()}/{ZIP_DIR}").stdout
-        num_bytes = int(du_result.split()[0])
-        zip_proc = subprocess.Popen(
-            # "-" = write zip to stdout
-            ["zip", "-rq", "-", f"{parent_dir()}/{ZIP_DIR}"],
-            stdout=subprocess.PIPE,
-        )
-        with open(COMPRESSED_BACKUP_PATH, "wb") as out_file:
-            # piped output to progress viewer to see progress bar
-            pv_proc = subprocess.Popen(["pv", "-s", str(num_bytes)], stdin=zip_proc.stdout, stdout=out_file)
-            if zip_proc.stdout:
-                # let zip_proc get SIGPIPE if pv exits
-                zip_proc.stdout.close()
-            pv_proc.communicate()
-        run("rm", "-rf", BACKUP_WORKSPACE, capture_output=False)
-        if LIVE:
-            self.logger.info(f"Uploading backup to rclone remote: '{config.rclone_remote}'.")
-            run("rclone", "copy", COMPRESSED_BACKUP_PATH, config.rclone_remote, capture_output=False)
-        else:
-            self.logger.info("Skipping upload to rclone because the '--live' flag is false.")
-        run("rm", "-rf", COMPRESSED_BACKUP_PATH)
+        try:
+            # Dumps run one at a time: dumping sets PGPASSWORD in the process-wide environment, so concurrent
+            # dumps could race and connect with another database's password.
+            for i, db in enumerate(sorted(config.databases, key=lambda db: db.name)):
+                # use index to make sure names are unique and throw in db name for identification
+                self.logger.info(f"Dumping database {db}...")
+                dump_path = f"{BACKUP_WORKSPACE}/{BACKUP_TIMESTAMP}_{db.name.translate(_SANITIZE)}_{i}"
+                db.dump(dump_path)
+
+            if MULTI_FILE_UPLOAD:
+                if LIVE:
+                    destination = remote_path(config.rclone_remote, BACKUP_NAME)
+                    self.logger.info(f"Uploading backup files to rclone remote: '{destination}'.")
+                    self._upload_files(dir_paths, BACKUP_WORKSPACE, destination)
+                else:
+                    self.logger.info("Skipping upload to rclone because the '--live' flag is false.")
+            else:
+                self.logger.info(f"Compressing backup directories {config.dirs} to {COMPRESSED_BACKUP_PATH}...")
+                self._compress(dir_paths, BACKUP_WORKSPACE, COMPRESSED_BACKUP_PATH, args.compression_level)
+        finally:
+            # the workspace holds plaintext database dumps, so never leave it behind, even when a step fails
+            shutil.rmtree(BACKUP_WORKSPACE, ignore_errors=True)
 
-        if get_arguments().disable_pruning == True:
+        if not MULTI_FILE_UPLOAD:
+            try:
+                if LIVE:
+                    self.logger.info(f"Uploading backup to rclone remote: '{config.rclone_remote}'.")
+                    run("rclone", "copy", COMPRESSED_BACKUP_PATH, config.rclone_remote, capture_output=False)
+                else:
+                    self.logger.info("Skipping upload to rclone because the '--live' flag is false.")
+            finally:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(COMPRESSED_BACKUP_PATH)
+
+        if args.disable_pruning == True:
             self.logger.info("Skipping pruning because '--disable-pruning' was passed as an argument.")
         else:
-            PRUNE_FILE = f"{parent_path()}/to_prune.txt"
             if LIVE:
                 self.logger.info("Pruning old backup files...")
-                refresh_current_backups_from_rclone(config)
-
-                # Find backups to prune
-                with open(f"{parent_path()}/current_backups.txt", "r") as f:
-                    filenames = [line.strip() for line in f if line.strip()]
-                to_prune = should_prune(
-                    filenames=filenames,
-                    file_format=f"{prefix}{config.file_format.datetime}.zip",
-                    keep_daily=config.pruning.keep_daily,
-                    keep_weekly=config.pruning.keep_weekly,
-                    keep_monthly=config.pruning.keep_monthly,
-                    keep_yearly=config.pruning.keep_yearly,
-                )
-                with open(PRUNE_FILE, "w") as f:
-                    for fn in to_prune:
-                        f.write(fn + "\n")
-                self.logger.debug(f"Prune list written to {PRUNE_FILE}. {len(to_prune)} files to prune.")
-
-                # Prune backups
-                with open(PRUNE_FILE, "r") as prune_file:
-                    for backup_filename in prune_file.readlines():
-                        backup_filename = backup_filename.replace("\n", "")
-                        self.logger.info(f"Pruning {backup_filename}...")
-                        run("rclone", "delete", f"{config.rclone_remote}/{backup_filename}", capture_output=False)
+                self._prune(BACKUP_SUFFIX, MULTI_FILE_UPLOAD)
             else:
                 self.logger.info("Skipping pruning because the '--live' flag is false.")
-            run("rm", "-rf", PRUNE_FILE)
 
         # refresh again to update the backups list after backup is complete
         if LIVE:
-            refresh_current_backups_from_rclone(config)
+            try:
+                refresh_current_backups_from_rclone(config)
+            except subprocess.CalledProcessError as e:
+                # the backup itself is already uploaded, so a failed listing shouldn't fail the run
+                self.logger.warning(f"Skipping refresh because the rclone remote could not be listed: {e.stderr}")
         else:
             self.logger.info("Skipping refresh because the '--live' flag is false.")
 
@@ -343,7 +492,13 @@ if __name__ == "__main__":
                     runner.logger.info(f"Next run in {format_seconds(int(next_run_in))}. Going to sleep...")
                 except Exception as e:
                     runner.logger.error("Backup failed.", exc_info=e)
-            time.sleep(30)  # check against service mode schedule around every 30 seconds
+                    next_run_in = 30  # retry failed backups after 30 seconds
+            # Sleep straight until the next run instead of polling, but wake at least every 5 minutes so
+            # the schedule is re-checked against the wall clock, e.g., after a suspend or a clock change.
+            # write out the buffered log lines, including "Going to sleep...", before sleeping for possibly days
+            for handler in runner.logger.handlers:
+                handler.flush()
+            time.sleep(min(300, max(0, next_run_in)))
     else:
         # Run once...
         try:
@@ -1,4 +1,5 @@
-from typing import Any, Dict
+import os
+from typing import Any, Dict, List
 
 import pytest
 import yaml
@@ -32,5 +33,121 @@ def test_load_data_bad_path_raises(write_test_config):
 def test_load_data_invalid_yaml_raises(tmp_path):
     path = tmp_path / "config.yaml"
     path.write_text(yaml.dump("list: [1, 2, 3", sort_keys=False))
-    with pytest.raises(Config.ConfigLoadError, match=f"YAML parsing error"):
+    with pytest.raises(Config.ConfigLoadError, match="must contain a mapping"):
         data = Config._load_data(path)
+
+
+def test_load_data_unparseable_yaml_raises(tmp_path):
+    path = tmp_path / "config.yaml"
+    path.write_text("list: [1, 2, 3")
+    with pytest.raises(Config.ConfigLoadError, match="YAML parsing error"):
+        Config._load_data(path)
+
+
+def test_load_data_non_mapping_raises(write_test_config):
+    path = write_test_config(["not", "a", "mapping"])
+    with pytest.raises(Config.ConfigLoadError, match="must contain a mapping"):
+        Config._load_data(path)
+
+
+def test_env_vars_are_expanded(monkeypatch):
+    monkeypatch.setenv("BACKUP_PREFIX", "nightly")
+    file_format = Config.FileFormat(prefix="${BACKUP_PREFIX}_${BACKUP_PREFIX}", datetime="%Y-%m-%d")
+    assert file_format.prefix == "nightly_nightly"
+    assert file_format.datetime == "%Y-%m-%d"
+
+
+def test_missing_env_var_raises(monkeypatch):
+    monkeypatch.setenv("BACKUP_PREFIX", "nightly")
+    monkeypatch.delenv("NOT_A_REAL_VAR", raising=False)
+    with pytest.raises(Config.ConfigBuildError, match="missing from the environment"):
+        Config.FileFormat(prefix="${BACKUP_PREFIX}_${NOT_A_REAL_VAR}", datetime="%Y-%m-%d")
+
+
+
+def _config_with_dirs(dirs: List[str]) -> Config:
+    return Config(
+        rclone_remote="remote:",
+        file_format=Config.FileFormat(prefix="backup", datetime="%Y-%m-%d"),
+        dirs=dirs,
+        pruning=Config.PruningStrategy(keep_daily=7, keep_weekly=4, keep_monthly=6, keep_yearly=2),
+        databases=[],
+        logdir="logs",
+    )
+
+
+def test_env_vars_in_lists_are_expanded(monkeypatch):
+    monkeypatch.setenv("BACKUP_ROOT", "/srv")
+    assert _config_with_dirs(["${BACKUP_ROOT}/x", "plain"]).dirs == ["/srv/x", "plain"]
+
+
+def test_missing_env_var_in_list_raises(monkeypatch):
+    monkeypatch.delenv("NOT_A_REAL_VAR", raising=False)
+    with pytest.raises(Config.ConfigBuildError, match="missing from the environment"):
+        _config_with_dirs(["plain", "${NOT_A_REAL_VAR}/x"])
+
+
+@pytest.fixture
+def valid_config_data() -> Dict[str, Any]:
+    return {
+        "rclone": {"remote": "remote:"},
+        "format": {"prefix": "backup", "datetime": "%Y-%m-%d_%I-%M-%S_%p"},
+        "dirs": ["some/dir"],
+        "pruning": {"keep_daily": 7, "keep_weekly": 4, "keep_monthly": 6, "keep_yearly": 2},
+        "databases": {"postgres": None, "sqlite": None},
+        "logs": {"dir": "logs"},
+    }
+
+
+def test_build(write_test_config, valid_config_data):
+    config = Config.build(write_test_config(valid_config_data))
+    assert config.rclone_remote == "remote:"
+    assert config.file_format == Config.FileFormat(prefix="backup", datetime="%Y-%m-%d_%I-%M-%S_%p")
+    assert config.dirs == ["some/dir"]
+    assert config.pruning.keep_weekly == 4
+    assert config.databases == []
+    assert config.logdir == "logs"
+
+
+def test_build_is_cached_until_file_changes(write_test_config, valid_config_data):
+    path = write_test_config(valid_config_data)
+    config = Config.build(path)
+    assert Config.build(path) is config
+
+    valid_config_data["rclone"]["remote"] = "other_remote:"
+    write_test_config(valid_config_data)
+    os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 1))
+    rebuilt = Config.build(path)
+    assert rebuilt is not config
+    assert rebuilt.rclone_remote == "other_remote:"
+
+
+def test_build_bad_path_raises():
+    with pytest.raises(Config.ConfigLoadError, match="could not be found"):
+        Config.build("not/a/real/path.yaml")
+
+
+def test_build_databases(write_test_config, valid_config_data):
+    valid_config_data["databases"] = {
+        "postgres": [
+            {"name": "app", "host": "localhost", "port": 5432, "username": "dodo", "password": "secret"},
+        ],
+        "sqlite": [{"path": "data/app.db"}],
+    }
+    config = Config.build(write_test_config(valid_config_data))
+    postgres, sqlite = config.databases
+    assert postgres.provider == Config.Database.Provider.POSTGRES
+    assert (postgres.name, postgres.host, postgres.port) == ("app", "localhost", 5432)
+    assert sqlite.provider == Config.Database.Provider.SQLITE
+    assert sqlite.name == "data/app.db"
+
+
+def test_build_missing_key_raises(write_test_config, valid_config_data):
+    del valid_config_data["logs"]
+    with pytest.raises(Config.ConfigBuildError):
+        Config.build(write_test_config(valid_config_data))
+
+
+@pytest.mark.parametrize("prefix, expected", [("backup", "backup_"), ("", ""), ("  ", "")])
+def test_file_format_effective_prefix(prefix, expected):
+    assert Config.FileFormat(prefix=prefix, datetime="%Y").effective_prefix == expected
@@ -0,0 +1,29 @@
+from datetime import datetime, timedelta
+
+from src.get_backups_to_prune import should_prune
+
+FILE_FORMAT = "backup_%Y-%m-%d_%I-%M-%S_%p.tar.zst"
+
+
+def backup_name(days_ago: int, file_format: str = FILE_FORMAT) -> str:
+    return (datetime.now() - timedelta(days=days_ago)).strftime(file_format)
+
+
+def test_should_prune_ignores_names_that_do_not_match_format():
+    old_backup = backup_name(400)
+    filenames = [
+        backup_name(1, "backup_%Y-%m-%d_%I-%M-%S_%p.zip"),
+        backup_name(1, "backup_%Y-%m-%d_%I-%M-%S_%p/"),
+        "some_stray_object.txt",
+        backup_name(1),
+        old_backup,
+    ]
+    to_prune = should_prune(
+        filenames=filenames,
+        file_format=FILE_FORMAT,
+        keep_daily=7,
+        keep_weekly=0,
+        keep_monthly=0,
+        keep_yearly=0,
+    )
+    assert to_prune == [old_backup]
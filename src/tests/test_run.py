@@ -0,0 +1,213 @@
+import logging
+import shutil
+import subprocess
+
+import pytest
+
+import src.run
+from src.config import Config
+from src.run import Arguments, BackupRunner, disk_usage, format_seconds, remote_path
+
+
+@pytest.mark.parametrize(
+    "seconds, expected",
+    [
+        (0, "0m"),
+        (59, "0m"),
+        (61, "1m"),
+        (3600, "1h 0m"),
+        (3 * 3600 + 25 * 60, "3h 25m"),
+        (86400, "1d 0h 0m"),
+        (2 * 86400 + 5 * 3600 + 7 * 60 + 30, "2d 5h 7m"),
+    ],
+)
+def test_format_seconds(seconds, expected):
+    assert format_seconds(seconds) == expected
+
+
+def test_disk_usage_sums_nested_files(tmp_path):
+    (tmp_path / "a").mkdir()
+    (tmp_path / "a" / "b").mkdir()
+    (tmp_path / "a" / "one.txt").write_bytes(b"x" * 10)
+    (tmp_path / "a" / "b" / "two.txt").write_bytes(b"x" * 32)
+    (tmp_path / "c").mkdir()
+    (tmp_path / "c" / "three.txt").write_bytes(b"x" * 100)
+    assert disk_usage(str(tmp_path / "a")) == 10 + 32
+    assert disk_usage(str(tmp_path / "a"), str(tmp_path / "c")) == 10 + 32 + 100
+
+
+def test_disk_usage_counts_single_files(tmp_path):
+    (tmp_path / "a").mkdir()
+    (tmp_path / "a" / "one.txt").write_bytes(b"x" * 10)
+    (tmp_path / "single.txt").write_bytes(b"x" * 7)
+    assert disk_usage(str(tmp_path / "single.txt")) == 7
+    assert disk_usage(str(tmp_path / "a"), str(tmp_path / "single.txt")) == 10 + 7
+
+
+def test_disk_usage_missing_path_is_empty(tmp_path):
+    assert disk_usage(str(tmp_path / "not_a_real_dir")) == 0
+
+
+@pytest.mark.skipif(shutil.which("tar") is None or shutil.which("zstd") is None, reason="requires tar and zstd")
+def test_compress_missing_dir_raises_and_removes_archive(tmp_path):
+    workspace = tmp_path / "workspace"
+    workspace.mkdir()
+    out_path = tmp_path / "backup.tar.zst"
+    runner = object.__new__(BackupRunner)
+    with pytest.raises(subprocess.CalledProcessError):
+        runner._compress([str(tmp_path / "not_a_real_dir")], str(workspace), str(out_path), 3)
+    assert not out_path.exists()
+
+
+@pytest.mark.skipif(shutil.which("tar") is None or shutil.which("zstd") is None, reason="requires tar and zstd")
+def test_compress_writes_archive(tmp_path):
+    source = tmp_path / "source"
+    source.mkdir()
+    (source / "file.txt").write_text("hello")
+    workspace = tmp_path / "workspace"
+    workspace.mkdir()
+    (workspace / "db.sql").write_text("dump")
+    out_path = tmp_path / "backup.tar.zst"
+    runner = object.__new__(BackupRunner)
+    runner._compress([str(source)], str(workspace), str(out_path), 3)
+    listing = subprocess.run(
+        f"zstd -dc --long {out_path} | tar -t", shell=True, capture_output=True, text=True, check=True
+    ).stdout.splitlines()
+    assert f"{str(source / 'file.txt').lstrip('/')}" in listing
+    assert "./db.sql" in listing
+
+
+def test_upload_files_includes_single_files_and_removes_manifest(tmp_path, monkeypatch):
+    source = tmp_path / "source"
+    (source / "nested").mkdir(parents=True)
+    (source / "nested" / "a.txt").write_text("a")
+    single_file = tmp_path / "single.txt"
+    single_file.write_text("b")
+    manifests = []
+
+    def fake_run(*args, **kwargs):
+        if "--files-from" in args:
+            with open(args[args.index("--files-from") + 1]) as manifest:
+                manifests.append(manifest.read().splitlines())
+            raise subprocess.CalledProcessError(1, args)
+
+    monkeypatch.setattr(src.run, "run", fake_run)
+    monkeypatch.setattr(src.run, "parent_path", lambda: str(tmp_path))
+    runner = object.__new__(BackupRunner)
+    with pytest.raises(subprocess.CalledProcessError):
+        runner._upload_files([str(source), str(single_file)], str(tmp_path), "remote:backup/")
+    assert sorted(manifests[0]) == sorted(
+        [str(source / "nested" / "a.txt").lstrip("/"), str(single_file).lstrip("/")]
+    )
+    assert not (tmp_path / "upload_manifest.txt").exists()
+
+
+@pytest.fixture
+def backup_runner(tmp_path, monkeypatch):
+    config = Config(
+        rclone_remote="remote:",
+        file_format=Config.FileFormat(prefix="backup", datetime="%Y-%m-%d_%I-%M-%S_%p"),
+        dirs=[],
+        pruning=Config.PruningStrategy(keep_daily=7, keep_weekly=4, keep_monthly=6, keep_yearly=2),
+        databases=[],
+        logdir="logs",
+    )
+    # run() reads the module-level config that __main__ sets up
+    monkeypatch.setattr(src.run, "config", config, raising=False)
+    monkeypatch.setattr(src.run, "parent_path", lambda: str(tmp_path))
+    monkeypatch.setattr(src.run, "parent_dir", lambda: str(tmp_path))
+    runner = object.__new__(BackupRunner)
+    runner.config = config
+    runner.logger = logging.getLogger("test_run")
+    return runner
+
+
+def set_arguments(monkeypatch, **overrides):
+    args = Arguments(
+        live=True,
+        log_level="INFO",
+        disable_pruning=True,
+        ignore_missing_dirs=False,
+        multi_file_upload=False,
+        compression_level=3,
+    )
+    monkeypatch.setattr(src.run, "get_arguments", lambda: args._replace(**overrides))
+
+
+@pytest.mark.parametrize("multi_file_upload, failing_step", [(False, "_compress"), (True, "_upload_files")])
+def test_run_removes_workspace_when_a_step_fails(
+    tmp_path, monkeypatch, backup_runner, multi_file_upload, failing_step
+):
+    set_arguments(monkeypatch, multi_file_upload=multi_file_upload)
+
+    def fail(*args, **kwargs):
+        raise subprocess.CalledProcessError(1, failing_step)
+
+    monkeypatch.setattr(BackupRunner, failing_step, fail)
+    with pytest.raises(subprocess.CalledProcessError):
+        backup_runner.run()
+    assert list(tmp_path.glob("*_tmp_backup_manager_workspace")) == []
+
+
+def test_run_completes_when_listing_the_remote_fails(monkeypatch, backup_runner, caplog):
+    set_arguments(monkeypatch, disable_pruning=False)
+    calls = []
+
+    def fake_run(*args, **kwargs):
+        calls.append(args[:2])
+        if args[:2] == ("rclone", "lsf"):
+            raise subprocess.CalledProcessError(1, args, stderr="connection reset")
+        return subprocess.CompletedProcess(args, 0, stdout="")
+
+    monkeypatch.setattr(src.run, "run", fake_run)
+    monkeypatch.setattr(BackupRunner, "_compress", lambda *args: None)
+    with caplog.at_level(logging.INFO, logger="test_run"):
+        backup_runner.run()
+    assert calls == [("rclone", "copy"), ("rclone", "lsf"), ("rclone", "lsf")]
+    assert "Skipping pruning because the rclone remote could not be listed" in caplog.text
+    assert "Skipping refresh because the rclone remote could not be listed" in caplog.text
+    assert "Done!" in caplog.text
+
+
+def test_parse_dirname_resolves_relative_paths(tmp_path, backup_runner):
+    (tmp_path / "data").mkdir()
+    assert backup_runner._parse_dirname("data", str(tmp_path), ignore_missing=False) == f"{tmp_path}/data"
+    assert backup_runner._parse_dirname(str(tmp_path), "/unused", ignore_missing=False) == str(tmp_path)
+
+
+def test_parse_dirname_missing_dir_raises_dir_not_found(tmp_path, backup_runner):
+    with pytest.raises(BackupRunner.DirNotFound):
+        backup_runner._parse_dirname("missing", str(tmp_path), ignore_missing=False)
+
+
+def test_parse_dirname_missing_dir_is_skipped_when_ignoring_missing(tmp_path, backup_runner):
+    with pytest.raises(BackupRunner.SkipDir):
+        backup_runner._parse_dirname("missing", str(tmp_path), ignore_missing=True)
+
+
+@pytest.mark.parametrize(
+    "remote, path, expected",
+    [
+        ("remote:", "backup_ts/", "remote:backup_ts/"),
+        ("remote:", "/backup_ts/", "remote:backup_ts/"),
+        ("remote:backups", "backup_ts/", "remote:backups/backup_ts/"),
+        ("remote:backups/", "backup_ts/", "remote:backups/backup_ts/"),
+        ("/", "backup_ts/**", "/backup_ts/**"),
+    ],
+)
+def test_remote_path(remote, path, expected):
+    assert remote_path(remote, path) == expected
+
+
+def test_prune_multi_file_backups_uses_anchored_includes(monkeypatch, backup_runner):
+    calls = []
+    old = "backup2000-01-01_12-00-00_AM/"
+
+    def fake_run(*args, **kwargs):
+        calls.append(args)
+        return subprocess.CompletedProcess(args, 0, stdout=old if args[:2] == ("rclone", "lsf") else "")
+
+    monkeypatch.setattr(src.run, "run", fake_run)
+    monkeypatch.setattr(src.run, "should_prune", lambda filenames, **kwargs: filenames)
+    backup_runner._prune("/", multi_file_upload=True)
+    assert calls[-1] == ("rclone", "delete", "remote:", "--include", f"/{old}**", "--rmdirs")